@@ -1,9 +1,14 @@
 import os
+import asyncio
+import hashlib
 import logging
-import json
-from datetime import datetime
+import threading
+import orjson
 
-from supabase import create_client, Client
+import asyncpg
+import httpx
+from cachetools import TTLCache
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,188 +22,468 @@ if not SUPABASE_URL or not SUPABASE_KEY:
     logging.error("Las variables de entorno SUPABASE_URL o SUPABASE_KEY no están configuradas.")
     raise ValueError("Configuración de Supabase incompleta.")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# --- Funciones para la tabla 'users' ---
-def get_user(id: int):
-    """Obtiene datos de un usuario por su ID de Telegram."""
-    try:
-        response = supabase.table("users_image").select("*").eq("id", id).execute()
-        data = response.data
-        return data[0] if data else None
-    except Exception as e:
-        logging.error(f"Error al obtener usuario {id}: {e}")
-        return None
-
-def add_user(id: int, referred_by=None, initial_points=0):
-    """Añade un nuevo usuario a la base de datos con puntos iniciales y prioridad por defecto."""
-    user = get_user(id)
-    if user:
-        logging.warning(f"Usuario {id} ya existe. Saltando adición.")
-        return False
-
-    data = {
-        "id": id,
-        "points": initial_points,
-        "referred_by": referred_by,
-        "priority": 2  # CORREGIDO: Se usa 'priority'
-    }
-    try:
-        response = supabase.table("users_image").insert(data).execute()
-        if response.data:
-            logging.info(f"Usuario {id} añadido a la BD. Puntos: {initial_points}, Prioridad: 2.")
-            return True
-        logging.warning(f"No se pudo añadir usuario {id}: {response.json()}.")
-        return False
-    except Exception as e:
-        logging.warning(f"Error al añadir usuario {id} (puede que ya exista): {e}.")
-        return False
-
-def update_user_points(id: int, amount: int):
-    """Actualiza los puntos de un usuario."""
-    user = get_user(id)
-    if not user:
-        logging.warning(f"Usuario {id} no encontrado para actualizar puntos.")
-        return None
-
-    new_points = user["points"] + amount
-    try:
-        response = supabase.table("users_image").update({"points": new_points}).eq("id", id).execute()
-        if response.data:
-            logging.info(f"Puntos de usuario {id} actualizados en {amount} (total: {new_points}).")
-            return response.data[0]
-        logging.error(f"Error al actualizar puntos para el usuario {id}: {response.json()}.")
-        return None
-    except Exception as e:
-        logging.error(f"Error al actualizar puntos para el usuario {id}: {e}.")
-        return None
-
-def get_user_points(id: int) -> int:
-    """Obtiene el saldo actual de puntos de un usuario."""
-    user = get_user(id)
-    return user["points"] if user else 0
-
-def get_user_priority(id: int) -> int:
-    """Obtiene el nivel de prioridad actual de un usuario."""
-    user = get_user(id)
-    return user.get("priority", 2) if user else 2  # CORREGIDO: Se usa 'priority'
-
-def update_user_priority(id: int, new_priority_level: int):
-    """Actualiza el nivel de prioridad de un usuario."""
-    user = get_user(id)
-    if not user:
-        logging.warning(f"Usuario {id} no encontrado para actualizar prioridad.")
-        return False
-
-    current_priority = user.get("priority", 2)  # CORREGIDO: Se usa 'priority'
-    
-    if new_priority_level < current_priority:
+# Un único cliente HTTP/2 de larga vida para todo el proceso: mantiene calientes las
+# conexiones TCP+TLS con Supabase en lugar de negociarlas en cada petición.
+_http_client = httpx.Client(
+    http2=True,
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+)
+
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=_http_client))
+
+# Conexión directa a Postgres para la cola (rutas calientes). Con Supavisor/pgbouncer
+# en modo transacción no se pueden usar sentencias preparadas, de ahí statement_cache_size=0.
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+# LISTEN necesita una conexión de sesión: en modo transacción Supavisor/pgbouncer
+# no entrega las notificaciones, así que se permite indicar una URL directa aparte.
+SUPABASE_DB_LISTEN_URL = os.getenv("SUPABASE_DB_LISTEN_URL", SUPABASE_DB_URL)
+
+_pool: asyncpg.Pool | None = None
+_pool_lock = asyncio.Lock()
+
+# Instancias de Database creadas, para cerrar sus conexiones de escucha al apagar.
+_databases = []
+
+async def _init_connection(conn: asyncpg.Connection):
+    """Decodifica/codifica las columnas JSONB directamente como objetos Python."""
+    await conn.set_type_codec(
+        'jsonb',
+        encoder=lambda value: orjson.dumps(value).decode(),
+        decoder=orjson.loads,
+        schema='pg_catalog'
+    )
+
+async def get_pool() -> asyncpg.Pool:
+    """Devuelve el pool de conexiones a Postgres, creándolo en el primer uso."""
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                if not SUPABASE_DB_URL:
+                    logging.error("La variable de entorno SUPABASE_DB_URL no está configurada.")
+                    raise ValueError("Configuración de Supabase incompleta: falta SUPABASE_DB_URL.")
+                _pool = await asyncpg.create_pool(
+                    dsn=SUPABASE_DB_URL,
+                    min_size=5,
+                    max_size=20,
+                    statement_cache_size=0,
+                    init=_init_connection
+                )
+                logging.info("Pool de conexiones a Postgres inicializado.")
+    return _pool
+
+async def close_pool():
+    """Cierra el pool y las conexiones de escucha a Postgres (llamar al apagar la aplicación)."""
+    global _pool
+    for db in _databases:
+        await db.close_listener()
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+        logging.info("Pool de conexiones a Postgres cerrado.")
+
+# --- Funciones para las tablas 'workflows_<suffix>' ---
+def _hash_workflow(workflow_content: dict) -> bytes:
+    """Devuelve el hash SHA-256 del JSON canónico (claves ordenadas) de un workflow."""
+    return hashlib.sha256(orjson.dumps(workflow_content, option=orjson.OPT_SORT_KEYS)).digest()
+
+def _apply_overrides(workflow: dict, overrides: dict) -> dict:
+    """
+    Aplica sobre una plantilla de workflow (formato API de ComfyUI) los valores propios
+    de un trabajo. `overrides` asocia ID de nodo -> {nombre del input: valor}.
+    """
+    for node_id, inputs in overrides.items():
+        workflow[node_id]["inputs"].update(inputs)
+    return workflow
+
+def _decode_json(value):
+    """Decodifica un valor JSONB que llegue serializado como string; el resto se devuelve tal cual."""
+    return orjson.loads(value) if isinstance(value, str) else value
+
+class Database:
+    """
+    Acceso a las tablas de un proyecto: 'users_<suffix>' y 'generation_queue_<suffix>',
+    junto con sus funciones RPC ('<nombre>_<suffix>') y su canal de NOTIFY.
+    """
+
+    def __init__(self, suffix: str):
+        self.suffix = suffix
+        self.users = f"users_{suffix}"
+        self.queue = f"generation_queue_{suffix}"
+        self.new_job_channel = f"generation_queue_{suffix}_new"
+
+        # Caché en proceso de filas de usuario: colapsa las lecturas repetidas de get_user
+        # dentro de una misma ráfaga (webhook, handlers del bot). Se protege con un lock
+        # porque TTLCache no es thread-safe y el webhook puede llamar desde otros hilos.
+        self._user_cache = TTLCache(maxsize=10_000, ttl=5)
+        self._user_cache_lock = threading.Lock()
+
+        self.workflows = f"workflows_{suffix}"
+
+        # Hashes de plantillas que ya están en la BD: al encolar evita reenviar su cuerpo.
+        # Caducan en una hora, muy por debajo de la retención de prune_workflows, para no
+        # referenciar nunca desde otro proceso una plantilla que ya se haya borrado.
+        self._known_workflows = TTLCache(maxsize=256, ttl=3600)
+
+        self._listen_conn: asyncpg.Connection | None = None
+        self._listen_lock = asyncio.Lock()
+        self._new_job_event = asyncio.Event()
+
+        _databases.append(self)
+
+    def _rpc(self, name: str, params: dict = None):
+        """Ejecuta la función RPC '<name>_<suffix>' de este proyecto."""
+        return supabase.rpc(f"{name}_{self.suffix}", params or {}).execute()
+
+    def _cache_user(self, user: dict):
+        """Guarda en caché una copia de la fila más reciente de un usuario."""
+        with self._user_cache_lock:
+            self._user_cache[user["id"]] = dict(user)
+
+    def _invalidate_user(self, id: int):
+        """Elimina de la caché la fila de un usuario."""
+        with self._user_cache_lock:
+            self._user_cache.pop(id, None)
+
+    # --- Funciones para la tabla 'users' ---
+    def get_user(self, id: int):
+        """Obtiene datos de un usuario por su ID de Telegram."""
+        with self._user_cache_lock:
+            user = self._user_cache.get(id)
+        if user is not None:
+            # Copia: si el llamador modifica la fila no debe alterar la caché.
+            return dict(user)
+
         try:
-            response = supabase.table("users_image").update({'priority': new_priority_level}).eq('id', id).execute()  # CORREGIDO: Se usa 'priority'
+            response = supabase.table(self.users).select("*").eq("id", id).execute()
+            data = response.data
+            if not data:
+                return None
+            self._cache_user(data[0])
+            return data[0]
+        except Exception as e:
+            logging.error(f"Error al obtener usuario {id}: {e}")
+            return None
+
+    def add_user(self, id: int, referred_by=None, initial_points=0):
+        """Añade un nuevo usuario a la base de datos con puntos iniciales y prioridad por defecto."""
+        with self._user_cache_lock:
+            cached = id in self._user_cache
+        if cached:
+            logging.warning(f"Usuario {id} ya existe. Saltando adición.")
+            return False
+
+        try:
+            response = self._rpc("add_user_if_absent", {"uid": id, "ref": referred_by, "pts": initial_points})
             if response.data:
-                logging.info(f"Prioridad del usuario {id} actualizada de {current_priority} a {new_priority_level}.")
+                self._cache_user(response.data[0])
+                logging.info(f"Usuario {id} añadido a la BD. Puntos: {initial_points}, Prioridad: 2.")
                 return True
-            logging.error(f"Error al actualizar prioridad del usuario {id}: {response.json()}.")
+            logging.warning(f"Usuario {id} ya existe. Saltando adición.")
             return False
         except Exception as e:
+            logging.warning(f"Error al añadir usuario {id}: {e}.")
+            return False
+
+    def update_user_points(self, id: int, amount: int):
+        """Actualiza los puntos de un usuario de forma atómica (un solo UPDATE en el servidor)."""
+        try:
+            response = self._rpc("increment_user_points", {"uid": id, "amt": amount})
+            if response.data:
+                user = response.data[0]
+                self._cache_user(user)
+                logging.info(f"Puntos de usuario {id} actualizados en {amount} (total: {user['points']}).")
+                return user
+            logging.warning(f"Usuario {id} no encontrado para actualizar puntos.")
+            return None
+        except Exception as e:
+            # No sabemos si el UPDATE llegó a aplicarse: forzamos una relectura.
+            self._invalidate_user(id)
+            logging.error(f"Error al actualizar puntos para el usuario {id}: {e}.")
+            return None
+
+    def update_user_points_bulk(self, amounts: dict):
+        """Suma puntos a varios usuarios en un único UPDATE atómico. `amounts` asocia ID de usuario -> cantidad."""
+        if not amounts:
+            return []
+        try:
+            response = self._rpc(
+                "increment_user_points_bulk",
+                {"uids": list(amounts.keys()), "amts": list(amounts.values())}
+            )
+            for user in response.data:
+                self._cache_user(user)
+            logging.info(f"Puntos actualizados para {len(response.data)} de {len(amounts)} usuarios.")
+            return response.data
+        except Exception as e:
+            # No sabemos si el UPDATE llegó a aplicarse: forzamos una relectura.
+            for id in amounts:
+                self._invalidate_user(id)
+            logging.error(f"Error al actualizar puntos en bloque para {len(amounts)} usuarios: {e}.")
+            return []
+
+    def get_user_points(self, id: int) -> int:
+        """Obtiene el saldo actual de puntos de un usuario."""
+        user = self.get_user(id)
+        return user["points"] if user else 0
+
+    def get_user_priority(self, id: int) -> int:
+        """Obtiene el nivel de prioridad actual de un usuario."""
+        user = self.get_user(id)
+        return user.get("priority_level", 2) if user else 2
+
+    def update_user_priority(self, id: int, new_priority_level: int):
+        """Actualiza el nivel de prioridad de un usuario solo si la nueva es mejor (menor)."""
+        try:
+            response = self._rpc("update_user_priority", {"uid": id, "prio": new_priority_level})
+            if response.data:
+                self._cache_user(response.data[0])
+                logging.info(f"Prioridad del usuario {id} actualizada a {new_priority_level}.")
+                return True
+            logging.info(f"La nueva prioridad {new_priority_level} no es mejor que la actual para el usuario {id} (o el usuario no existe).")
+            return False
+        except Exception as e:
+            # No sabemos si el UPDATE llegó a aplicarse: forzamos una relectura.
+            self._invalidate_user(id)
             logging.error(f"Error al actualizar prioridad del usuario {id}: {e}.")
             return False
-    else:
-        logging.info(f"La nueva prioridad {new_priority_level} no es mejor que la actual {current_priority} para el usuario {id}.")
-        return False
 
-# --- Funciones para la tabla 'generation_queue' ---
-async def add_generation_job(user_id: int, chat_id: int, message_id: int, filepath: str, workflow_content: dict, selected_workflow_name: str, priority_level: int):
-    """
-    Añade un trabajo de generación a la cola persistente en Supabase.
-    """
-    job_data = {
-        'user_id': user_id,
-        'chat_id': chat_id,
-        'message_id': message_id,
-        'filepath': filepath,
-        'workflow_content': json.dumps(workflow_content),
-        'selected_workflow_name': selected_workflow_name,
-        'status': 'pending',
-        'priority_level': priority_level  # CORRECTO: Se mantiene 'priority_level'
-    }
-    try:
-        response = supabase.table("generation_queue_image").insert(job_data).execute()
-        if response.data:
-            logging.info(f"Trabajo de generación para {user_id} añadido. ID del trabajo: {response.data[0]['id']}.")
-            return response.data[0]['id']
-        logging.error(f"Error al añadir trabajo de generación: {response.json()}.")
-        return None
-    except Exception as e:
-        logging.error(f"Error al añadir trabajo de generación para usuario {user_id}: {e}.")
-        return None
-        
-async def get_next_generation_job():
-    """Obtiene el siguiente trabajo de la cola con la prioridad más alta."""
-    try:
-        response = supabase.table("generation_queue_image") \
-            .select('*') \
-            .eq('status', 'pending') \
-            .order('priority_level', asc=True) \
-            .order('created_at', asc=True) \
-            .limit(1) \
-            .execute()
-
-        if not response.data:
+    def process_stripe_purchase(self, session_id: str, id: int, points: int, priority_level: int):
+        """
+        Aplica una compra de Stripe exactamente una vez, en una sola transacción:
+        registra la sesión, suma los puntos y mejora la prioridad del usuario.
+        Devuelve la fila actualizada, False si la sesión ya estaba procesada y None si hubo
+        un error (en ese caso la transacción no se aplicó y la compra puede reintentarse).
+        """
+        try:
+            response = self._rpc("process_stripe_purchase", {"sid": session_id, "uid": id, "pts": points, "prio": priority_level})
+            if response.data:
+                user = response.data[0]
+                self._cache_user(user)
+                logging.info(f"Compra {session_id} aplicada al usuario {id}: +{points} puntos (total: {user['points']}), prioridad: {user['priority_level']}.")
+                return user
+            logging.info(f"La sesión de Stripe {session_id} ya estaba procesada. Se ignora.")
+            return False
+        except Exception as e:
+            # No sabemos si la transacción llegó a confirmarse: forzamos una relectura.
+            self._invalidate_user(id)
+            logging.error(f"Error al procesar la compra {session_id} para el usuario {id}: {e}.")
+            return None
+
+    # --- Funciones para la tabla 'generation_queue' ---
+    async def add_generation_job(self, user_id: int, chat_id: int, message_id: int, filepath: str, workflow_content: dict, selected_workflow_name: str, priority_level: int, overrides: dict = None):
+        """
+        Añade un trabajo de generación a la cola persistente en Supabase.
+        `workflow_content` debe ser la plantilla sin modificar y `overrides` los valores propios
+        del trabajo (semilla, prompt, imagen de entrada...; ver _apply_overrides). Así todos los
+        trabajos de una misma plantilla comparten hash y su cuerpo solo se envía la primera vez.
+        """
+        workflow_hash = _hash_workflow(workflow_content)
+        insert_job = f"""
+            INSERT INTO {self.queue}
+                (user_id, chat_id, message_id, filepath, workflow_hash, workflow_overrides, selected_workflow_name, status, priority_level)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, 'pending', $8)
+            RETURNING id
+        """
+        args = [user_id, chat_id, message_id, filepath, workflow_hash, overrides, selected_workflow_name, priority_level]
+        if workflow_hash not in self._known_workflows:
+            # Primera vez que este proceso ve la plantilla: se guarda en la misma sentencia.
+            insert_job = f"""
+                WITH stored_workflow AS (
+                    INSERT INTO {self.workflows} (hash, body) VALUES ($5, $9)
+                    ON CONFLICT (hash) DO NOTHING
+                )
+            """ + insert_job
+            args.append(workflow_content)
+        try:
+            pool = await get_pool()
+            job_id = await pool.fetchval(insert_job, *args)
+            self._known_workflows[workflow_hash] = True
+            logging.info(f"Trabajo de generación para {user_id} añadido. ID del trabajo: {job_id}.")
+            return job_id
+        except Exception as e:
+            logging.error(f"Error al añadir trabajo de generación para usuario {user_id}: {e}.")
             return None
 
-        job = response.data[0]
-        job_id = job['id']
+    async def get_next_generation_job(self):
+        """Reclama atómicamente el siguiente trabajo de la cola con la prioridad más alta."""
+        try:
+            pool = await get_pool()
+            # El reclamo devuelve ya en 'workflow_content' el cuerpo de la plantilla: una sola consulta.
+            row = await pool.fetchrow(f"SELECT * FROM claim_next_generation_job_{self.suffix}()")
 
-        update_response = supabase.table("generation_queue_image") \
-            .update({'status': 'processing', 'started_at': datetime.now().isoformat()}) \
-            .eq('id', job_id) \
-            .eq('status', 'pending') \
-            .execute()
+            if not row:
+                return None
 
-        if update_response.data:
-            logging.info(f"Trabajo {job_id} marcado como 'processing'.")
-            job['workflow_content'] = json.loads(job['workflow_content'])
+            job = dict(row)
+            logging.info(f"Trabajo {job['id']} marcado como 'processing'.")
+            # El codec JSONB ya devuelve un dict recién decodificado (salvo los trabajos
+            # anteriores al JSONB nativo, que traen un string), así que aplicar los
+            # overrides nunca modifica nada compartido.
+            job['workflow_content'] = _decode_json(job['workflow_content'])
+            if job.get('workflow_overrides'):
+                _apply_overrides(job['workflow_content'], _decode_json(job['workflow_overrides']))
             return job
-        else:
-            logging.warning(f"Trabajo {job_id} ya fue tomado o su estado cambió. Reintentando la búsqueda...")
+
+        except Exception as e:
+            logging.error(f"Error al obtener o marcar trabajo de generación en cola: {e}.")
             return None
 
-    except Exception as e:
-        logging.error(f"Error al obtener o marcar trabajo de generación en cola: {e}.")
-        return None
-
-async def update_generation_job_status(job_id: str, status: str, output_files_urls: list = None, error_message: str = None):
-    """Actualiza el estado de un trabajo de generación en la cola persistente."""
-    update_data = {'status': status}
-    if status == 'completed':
-        update_data['completed_at'] = datetime.now().isoformat()
-        if output_files_urls:
-            update_data['output_files_urls'] = json.dumps(output_files_urls)
-    elif status in ('failed', 'refunded', 'canceled'):
-        update_data['error_message'] = error_message
-        update_data['completed_at'] = datetime.now().isoformat()
-
-    try:
-        response = supabase.table("generation_queue_image").update(update_data).eq('id', job_id).execute()
-        if response.data:
-            logging.info(f"Estado del trabajo {job_id} actualizado a {status}.")
-        else:
-            logging.error(f"Error al actualizar estado del trabajo {job_id}: {response.json()}.")
-    except Exception as e:
-        logging.error(f"Error en update_generation_job_status para {job_id}: {e}.")
-
-async def get_uncompleted_processing_jobs():
-    """Recupera trabajos que quedaron en estado 'processing' de una sesión anterior."""
-    try:
-        response = supabase.table("generation_queue_image") \
-            .select('id, user_id, chat_id, filepath, selected_workflow_name') \
-            .eq('status', 'processing') \
-            .execute()
-        
-        if response.data:
-            logging.warning(f"Encontrados {len(response.data)} trabajos en estado 'processing' no completados tras un reinicio.")
-        return response.data
-    except Exception as e:
-        logging.error(f"Error al recuperar trabajos 'processing' no completados: {e}.")
-        return []
\ No newline at end of file
+    async def prune_workflows(self, retention_days: int = 30):
+        """
+        Borra las plantillas de workflow que no usa ningún trabajo activo ni encolado en los
+        últimos `retention_days` días (mínimo 1, más que la caducidad de _known_workflows). Pensado para ejecutarse periódicamente (p. ej. al
+        arrancar el worker, junto a recover_uncompleted_processing_jobs).
+        """
+        try:
+            pool = await get_pool()
+            pruned = await pool.fetchval(
+                f"SELECT prune_workflows_{self.suffix}(make_interval(days => $1))",
+                max(retention_days, 1)
+            )
+            if pruned:
+                logging.info(f"Eliminadas {pruned} plantillas de workflow sin uso.")
+            self._known_workflows.clear()
+            return pruned
+        except Exception as e:
+            logging.error(f"Error al limpiar plantillas de workflow sin uso: {e}.")
+            return 0
+
+    def _on_new_job(self, conn, pid, channel, payload):
+        """Despierta a los workers que esperan en wait_for_next_generation_job."""
+        self._new_job_event.set()
+
+    async def _ensure_listener(self):
+        """Abre (o reabre si se cayó) la conexión que escucha el canal de trabajos nuevos."""
+        async with self._listen_lock:
+            if self._listen_conn is not None and not self._listen_conn.is_closed():
+                return
+            if not SUPABASE_DB_LISTEN_URL:
+                raise ValueError("Configuración de Supabase incompleta: falta SUPABASE_DB_URL.")
+            self._listen_conn = await asyncpg.connect(SUPABASE_DB_LISTEN_URL, statement_cache_size=0)
+            await self._listen_conn.add_listener(self.new_job_channel, self._on_new_job)
+            logging.info(f"Escuchando notificaciones de trabajos nuevos en '{self.new_job_channel}'.")
+
+    async def close_listener(self):
+        """Cierra la conexión de escucha del canal de trabajos nuevos, si está abierta."""
+        if self._listen_conn is not None:
+            await self._listen_conn.close()
+            self._listen_conn = None
+
+    async def wait_for_next_generation_job(self, poll_interval: float = 30):
+        """
+        Espera hasta reclamar un trabajo de la cola.
+        Se despierta con el NOTIFY que emite cada inserción y, como respaldo ante
+        notificaciones perdidas o caídas de la conexión, reintenta cada `poll_interval` segundos.
+        """
+        while True:
+            try:
+                await self._ensure_listener()
+            except Exception as e:
+                logging.error(f"No se pudo escuchar '{self.new_job_channel}', se usará solo el sondeo periódico: {e}.")
+
+            # Se limpia antes de reclamar para no perder los avisos que lleguen mientras tanto.
+            self._new_job_event.clear()
+            job = await self.get_next_generation_job()
+            if job:
+                # El clear() de arriba puede haber consumido avisos de otros trabajos:
+                # se despierta al resto de workers del proceso para que revisen la cola.
+                self._new_job_event.set()
+                return job
+
+            try:
+                await asyncio.wait_for(self._new_job_event.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def update_generation_job_status(self, job_id: str, status: str, output_files_urls: list = None, error_message: str = None):
+        """Actualiza el estado de un trabajo de generación en la cola persistente."""
+        update_data = {'status': status}
+        finished = False
+        if status == 'completed':
+            finished = True
+            if output_files_urls:
+                update_data['output_files_urls'] = output_files_urls
+        elif status in ('failed', 'refunded', 'canceled'):
+            update_data['error_message'] = error_message
+            finished = True
+
+        # Las columnas provienen de las claves fijas de arriba, nunca de datos externos.
+        assignments = [f"{column} = ${i}" for i, column in enumerate(update_data, start=2)]
+        if finished:
+            # La marca de tiempo la pone Postgres, no se calcula ni se envía desde Python.
+            assignments.append("completed_at = now()")
+        try:
+            pool = await get_pool()
+            updated_id = await pool.fetchval(
+                f"UPDATE {self.queue} SET {', '.join(assignments)} WHERE id = $1 RETURNING id",
+                job_id, *update_data.values()
+            )
+            if updated_id is not None:
+                logging.info(f"Estado del trabajo {job_id} actualizado a {status}.")
+            else:
+                logging.error(f"Error al actualizar estado del trabajo {job_id}: trabajo no encontrado.")
+        except Exception as e:
+            logging.error(f"Error en update_generation_job_status para {job_id}: {e}.")
+
+    async def get_uncompleted_processing_jobs(self):
+        """Recupera trabajos que quedaron en estado 'processing' de una sesión anterior."""
+        try:
+            pool = await get_pool()
+            rows = await pool.fetch(
+                f"""
+                SELECT id, user_id, chat_id, filepath, selected_workflow_name
+                FROM {self.queue}
+                WHERE status = 'processing'
+                """
+            )
+
+            if rows:
+                logging.warning(f"Encontrados {len(rows)} trabajos en estado 'processing' no completados tras un reinicio.")
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logging.error(f"Error al recuperar trabajos 'processing' no completados: {e}.")
+            return []
+
+    async def recover_uncompleted_processing_jobs(self):
+        """
+        Marca como 'failed' los trabajos que quedaron en 'processing' de una sesión anterior
+        y los devuelve, en un solo UPDATE, para que el llamador reembolse los puntos
+        (por ejemplo con update_user_points_bulk).
+        """
+        try:
+            pool = await get_pool()
+            rows = await pool.fetch(
+                f"""
+                SELECT id, user_id, chat_id, filepath, selected_workflow_name
+                FROM recover_stale_generation_jobs_{self.suffix}()
+                """
+            )
+
+            if rows:
+                logging.warning(f"Marcados como fallidos {len(rows)} trabajos en estado 'processing' no completados tras un reinicio.")
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logging.error(f"Error al recuperar trabajos 'processing' no completados: {e}.")
+            return []
+
+# Base de datos de este proyecto (users_image / generation_queue_image).
+db_image = Database("image")
+
+# Alias a nivel de módulo para el código existente que usa database.<función>.
+get_user = db_image.get_user
+add_user = db_image.add_user
+update_user_points = db_image.update_user_points
+update_user_points_bulk = db_image.update_user_points_bulk
+get_user_points = db_image.get_user_points
+get_user_priority = db_image.get_user_priority
+update_user_priority = db_image.update_user_priority
+process_stripe_purchase = db_image.process_stripe_purchase
+add_generation_job = db_image.add_generation_job
+get_next_generation_job = db_image.get_next_generation_job
+wait_for_next_generation_job = db_image.wait_for_next_generation_job
+update_generation_job_status = db_image.update_generation_job_status
+get_uncompleted_processing_jobs = db_image.get_uncompleted_processing_jobs
+recover_uncompleted_processing_jobs = db_image.recover_uncompleted_processing_jobs
+prune_workflows = db_image.prune_workflows
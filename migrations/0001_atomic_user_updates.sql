@@ -0,0 +1,26 @@
+-- Actualizaciones atómicas de puntos y prioridad en 'users_image'.
+-- Sustituyen el patrón SELECT + UPDATE desde Python por un único UPDATE en el servidor.
+
+CREATE OR REPLACE FUNCTION increment_user_points_image(uid bigint, amt integer)
+RETURNS SETOF users_image
+LANGUAGE sql
+AS $$
+    UPDATE users_image
+    SET points = points + amt
+    WHERE id = uid
+    RETURNING *;
+$$;
+
+-- Solo se aplica si la nueva prioridad es mejor (numéricamente menor) que la actual,
+-- así que el valor resultante es siempre LEAST(actual, nueva). No devuelve filas si
+-- el usuario no existe o si la prioridad no mejora.
+CREATE OR REPLACE FUNCTION update_user_priority_image(uid bigint, prio integer)
+RETURNS SETOF users_image
+LANGUAGE sql
+AS $$
+    UPDATE users_image
+    SET priority = prio
+    WHERE id = uid
+      AND COALESCE(priority, 2) > prio
+    RETURNING *;
+$$;
@@ -0,0 +1,20 @@
+-- Reclama atómicamente el siguiente trabajo pendiente de 'generation_queue_image'.
+-- FOR UPDATE SKIP LOCKED permite que varios workers reclamen en paralelo sin
+-- bloquearse entre sí ni quedarse con el mismo trabajo.
+
+CREATE OR REPLACE FUNCTION claim_next_generation_job_image()
+RETURNS SETOF generation_queue_image
+LANGUAGE sql
+AS $$
+    UPDATE generation_queue_image
+    SET status = 'processing', started_at = now()
+    WHERE id = (
+        SELECT id
+        FROM generation_queue_image
+        WHERE status = 'pending'
+        ORDER BY priority_level ASC, created_at ASC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+$$;
@@ -0,0 +1,13 @@
+-- Aplica una compra de Stripe en un único UPDATE atómico: suma los puntos y
+-- conserva la mejor prioridad (numéricamente menor) entre la actual y la comprada.
+
+CREATE OR REPLACE FUNCTION apply_purchase_image(uid bigint, pts integer, prio integer)
+RETURNS SETOF users_image
+LANGUAGE sql
+AS $$
+    UPDATE users_image
+    SET points = points + pts,
+        priority = LEAST(COALESCE(priority, 2), prio)
+    WHERE id = uid
+    RETURNING *;
+$$;
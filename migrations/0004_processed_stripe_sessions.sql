@@ -0,0 +1,7 @@
+-- Registro de sesiones de Stripe ya procesadas, para que los reintentos del
+-- webhook no acrediten la misma compra dos veces.
+
+CREATE TABLE IF NOT EXISTS processed_stripe_sessions (
+    session_id text PRIMARY KEY,
+    processed_at timestamptz NOT NULL DEFAULT now()
+);
@@ -0,0 +1,10 @@
+-- Índice parcial que coincide con la consulta de claim_next_generation_job_image():
+-- WHERE status = 'pending' ORDER BY priority_level, created_at LIMIT 1.
+-- Convierte el reclamo en la lectura de la primera entrada del índice, sin ordenar la cola.
+--
+-- CREATE INDEX CONCURRENTLY no puede ejecutarse dentro de una transacción:
+-- aplicar este archivo por separado (psql o el editor SQL de Supabase).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generation_queue_image_pending
+    ON generation_queue_image (priority_level ASC, created_at ASC)
+    WHERE status = 'pending';
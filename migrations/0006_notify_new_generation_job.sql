@@ -0,0 +1,18 @@
+-- Notifica a los workers cada vez que se encola un trabajo, para que esperen con
+-- LISTEN en lugar de consultar la cola periódicamente.
+
+CREATE OR REPLACE FUNCTION notify_new_generation_job_image()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('generation_queue_image_new', NEW.id::text);
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS notify_new_job ON generation_queue_image;
+CREATE TRIGGER notify_new_job
+    AFTER INSERT ON generation_queue_image
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_new_generation_job_image();
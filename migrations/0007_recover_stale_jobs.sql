@@ -0,0 +1,31 @@
+-- Recuperación tras un reinicio: marca en un solo UPDATE todos los trabajos que
+-- quedaron en 'processing' como fallidos y los devuelve para reembolsarlos.
+
+CREATE OR REPLACE FUNCTION recover_stale_generation_jobs_image()
+RETURNS SETOF generation_queue_image
+LANGUAGE sql
+AS $$
+    UPDATE generation_queue_image
+    SET status = 'failed',
+        error_message = 'worker_crashed',
+        completed_at = now()
+    WHERE status = 'processing'
+    RETURNING *;
+$$;
+
+-- Suma puntos a varios usuarios en un solo UPDATE. Los importes de un mismo
+-- usuario se agregan antes, porque UPDATE ... FROM aplica una sola fila por destino.
+CREATE OR REPLACE FUNCTION increment_user_points_bulk_image(uids bigint[], amts integer[])
+RETURNS SETOF users_image
+LANGUAGE sql
+AS $$
+    UPDATE users_image AS u
+    SET points = u.points + d.amt
+    FROM (
+        SELECT uid, sum(amt)::integer AS amt
+        FROM unnest(uids, amts) AS t(uid, amt)
+        GROUP BY uid
+    ) AS d
+    WHERE u.id = d.uid
+    RETURNING u.*;
+$$;
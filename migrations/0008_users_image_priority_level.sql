@@ -0,0 +1,27 @@
+-- Unifica el esquema con el resto de proyectos: 'users_image.priority' pasa a
+-- llamarse 'priority_level', como en 'users_h' y en las tablas de cola.
+-- Las funciones SQL guardan su cuerpo como texto, así que se recrean con el nuevo nombre.
+
+ALTER TABLE users_image RENAME COLUMN priority TO priority_level;
+
+CREATE OR REPLACE FUNCTION update_user_priority_image(uid bigint, prio integer)
+RETURNS SETOF users_image
+LANGUAGE sql
+AS $$
+    UPDATE users_image
+    SET priority_level = prio
+    WHERE id = uid
+      AND COALESCE(priority_level, 2) > prio
+    RETURNING *;
+$$;
+
+CREATE OR REPLACE FUNCTION apply_purchase_image(uid bigint, pts integer, prio integer)
+RETURNS SETOF users_image
+LANGUAGE sql
+AS $$
+    UPDATE users_image
+    SET points = points + pts,
+        priority_level = LEAST(COALESCE(priority_level, 2), prio)
+    WHERE id = uid
+    RETURNING *;
+$$;
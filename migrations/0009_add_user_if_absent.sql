@@ -0,0 +1,12 @@
+-- Alta de usuario en un único INSERT: si el usuario ya existe no hace nada y no
+-- devuelve filas, sin necesidad de consultarlo antes desde Python.
+
+CREATE OR REPLACE FUNCTION add_user_if_absent_image(uid bigint, ref bigint, pts integer)
+RETURNS SETOF users_image
+LANGUAGE sql
+AS $$
+    INSERT INTO users_image (id, points, referred_by, priority_level)
+    VALUES (uid, pts, ref, 2)
+    ON CONFLICT (id) DO NOTHING
+    RETURNING *;
+$$;
@@ -0,0 +1,75 @@
+-- Deduplicación de workflows: cada plantilla de workflow se guarda una sola vez,
+-- identificada por el SHA-256 de su JSON canónico, y los trabajos de la cola solo
+-- guardan el hash más los 'workflow_overrides' propios del trabajo (semilla, prompt,
+-- imagen de entrada...), que son los únicos datos que cambian entre trabajos.
+-- 'workflow_content' se conserva (nullable) para los trabajos encolados antes del cambio.
+
+CREATE TABLE IF NOT EXISTS workflows_image (
+    hash bytea PRIMARY KEY,
+    body jsonb NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- ON DELETE SET NULL: el historial de trabajos terminados no impide limpiar plantillas
+-- antiguas; prune_workflows_image() nunca borra las de trabajos activos.
+ALTER TABLE generation_queue_image
+    ADD COLUMN IF NOT EXISTS workflow_hash bytea REFERENCES workflows_image (hash) ON DELETE SET NULL,
+    ADD COLUMN IF NOT EXISTS workflow_overrides jsonb,
+    ALTER COLUMN workflow_content DROP NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_generation_queue_image_workflow_hash
+    ON generation_queue_image (workflow_hash);
+
+-- El reclamo devuelve también el cuerpo de la plantilla en la misma sentencia, para
+-- que el worker no necesite una segunda consulta tras marcar el trabajo: la fila
+-- devuelta lleva en 'workflow_content' el cuerpo unido desde 'workflows_image'
+-- (la fila guardada lo mantiene a NULL). Los trabajos antiguos sin hash conservan
+-- su 'workflow_content' original.
+DROP FUNCTION IF EXISTS claim_next_generation_job_image();
+CREATE FUNCTION claim_next_generation_job_image()
+RETURNS SETOF generation_queue_image
+LANGUAGE sql
+AS $$
+    WITH claimed AS (
+        UPDATE generation_queue_image
+        SET status = 'processing', started_at = now()
+        WHERE id = (
+            SELECT id
+            FROM generation_queue_image
+            WHERE status = 'pending'
+            ORDER BY priority_level ASC, created_at ASC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    )
+    SELECT (jsonb_populate_record(
+        ROW(claimed.*)::generation_queue_image,
+        CASE
+            WHEN workflows_image.body IS NULL THEN '{}'::jsonb
+            ELSE jsonb_build_object('workflow_content', workflows_image.body)
+        END
+    )).*
+    FROM claimed
+    LEFT JOIN workflows_image ON workflows_image.hash = claimed.workflow_hash;
+$$;
+
+-- Retención: borra las plantillas que ningún trabajo activo usa y que no se han
+-- encolado durante 'retention'. Devuelve el número de plantillas borradas.
+CREATE OR REPLACE FUNCTION prune_workflows_image(retention interval DEFAULT interval '30 days')
+RETURNS integer
+LANGUAGE sql
+AS $$
+    WITH pruned AS (
+        DELETE FROM workflows_image AS w
+        WHERE w.created_at < now() - retention
+          AND NOT EXISTS (
+              SELECT 1
+              FROM generation_queue_image AS q
+              WHERE q.workflow_hash = w.hash
+                AND (q.status IN ('pending', 'processing') OR q.created_at >= now() - retention)
+          )
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM pruned;
+$$;
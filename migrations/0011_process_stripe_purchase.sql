@@ -0,0 +1,33 @@
+-- Procesa una compra de Stripe de forma transaccional y exactamente una vez:
+-- registra la sesión y, solo si no estaba registrada, aplica puntos y prioridad.
+-- No devuelve filas si la sesión ya se había procesado; si el usuario no existe
+-- lanza una excepción, lo que deshace también el registro de la sesión.
+
+CREATE OR REPLACE FUNCTION process_stripe_purchase_image(sid text, uid bigint, pts integer, prio integer)
+RETURNS SETOF users_image
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO processed_stripe_sessions (session_id)
+    VALUES (sid)
+    ON CONFLICT (session_id) DO NOTHING;
+
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+        UPDATE users_image
+        SET points = points + pts,
+            priority_level = LEAST(COALESCE(priority_level, 2), prio)
+        WHERE id = uid
+        RETURNING *;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Usuario % no encontrado para la sesión de Stripe %', uid, sid;
+    END IF;
+END;
+$$;
+
+-- Sustituida por process_stripe_purchase_image: ya no la llama ningún código.
+DROP FUNCTION IF EXISTS apply_purchase_image(bigint, integer, integer);
@@ -1,15 +1,32 @@
-from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Header, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse
+import orjson
+import msgspec
 import stripe
 import os
+import asyncio
+from contextlib import asynccontextmanager
 import database  # Make sure this module handles a cloud DB (e.g., Supabase)
 from dotenv import load_dotenv
 from telegram import Bot # Import Bot to send confirmation messages
+from telegram.request import HTTPXRequest
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Keeps the Telegram bot's HTTP session open for the whole lifetime of the server."""
+    if bot:
+        try:
+            await bot.initialize()
+        except Exception as e:
+            logging.error(f"Error initializing Telegram bot: {e}")
+    yield
+    if bot:
+        await bot.shutdown()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Load environment variables (useful for local development, Render injects them directly)
 load_dotenv() 
@@ -28,7 +45,9 @@ if not STRIPE_WEBHOOK_SECRET:
     # Not a critical error for server startup, but necessary for secure webhooks.
 
 # Bot instance to send confirmations (if BOT_TOKEN is available)
-bot = Bot(token=BOT_TOKEN) if BOT_TOKEN else None
+# A single HTTP/2 session to api.telegram.org is reused for every confirmation;
+# pool_timeout bounds how long a send can wait for a free connection.
+bot = Bot(token=BOT_TOKEN, request=HTTPXRequest(http_version="2", pool_timeout=5)) if BOT_TOKEN else None
 if not bot:
     logging.warning("BOT_TOKEN not configured in the Stripe backend. Confirmation messages cannot be sent to Telegram.")
 
@@ -47,6 +66,51 @@ POINT_PACKAGES = {
 # Esto es crucial para el filtrado de webhooks.
 PROJECT_IDENTIFIER = "monkeynudesbot" # <--- IDENTIFICADOR ÚNICO PARA ESTE PROYECTO
 
+class PurchaseMetadata(msgspec.Struct):
+    """
+    Metadata attached to a checkout session by /crear-sesion.
+    Stripe returns every metadata value as a string; they are converted non-strictly.
+    Only the fields needed to credit a paid checkout are required: priority_boost is
+    kept as Stripe's raw string and parsed by _parse_priority_boost, so a bad value
+    never blocks the purchase. Points always come from POINT_PACKAGES, not metadata.
+    """
+    telegram_id: int
+    package_id: str
+    priority_boost: str = ""
+    project: str = ""
+
+def _parse_priority_boost(raw: str) -> int:
+    """Converts the metadata priority_boost to int, using default priority (2) if it is missing or invalid."""
+    try:
+        return int(raw)
+    except ValueError:
+        logging.warning(f"Webhook: Invalid or missing priority_boost in metadata: {raw!r}. Using default priority (2).")
+        return 2
+
+# Stripe line_items and the static part of the session metadata only depend on the
+# package, so they are built once at import instead of on every /crear-sesion request.
+_LINE_ITEMS = {
+    package_id: [{
+        "price_data": {
+            "currency": "usd",
+            "unit_amount": package["amount"],
+            "product_data": {
+                "name": package["label"]
+            }
+        },
+        "quantity": 1
+    }]
+    for package_id, package in POINT_PACKAGES.items()
+}
+_BASE_METADATA = {
+    package_id: {
+        "package_id": package_id,
+        "points_awarded": package["points"], # Also useful for the webhook
+        "project": PROJECT_IDENTIFIER        # <--- AÑADIDO: Identificador del proyecto
+    }
+    for package_id, package in POINT_PACKAGES.items()
+}
+
 @app.post("/crear-sesion")
 async def crear_sesion(request: Request):
     """
@@ -54,7 +118,14 @@ async def crear_sesion(request: Request):
     Called from your Telegram bot.
     """
     
-    data = await request.json()
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        logging.error(f"Invalid JSON in /crear-sesion: {e}")
+        return ORJSONResponse(status_code=400, content={"error": "Invalid data: malformed JSON body."})
+    if not isinstance(data, dict):
+        logging.error(f"Invalid JSON in /crear-sesion: expected an object, got {type(data).__name__}")
+        return ORJSONResponse(status_code=400, content={"error": "Invalid data: malformed JSON body."})
     id = str(data.get("telegram_id"))
     paquete_id = data.get("paquete_id")
     # ⬅️ We receive the priority_boost from the bot
@@ -63,55 +134,64 @@ async def crear_sesion(request: Request):
     # Validation
     if not id or paquete_id not in POINT_PACKAGES:
         logging.error(f"Invalid data in /crear-sesion: id={id}, paquete_id={paquete_id}")
-        return JSONResponse(status_code=400, content={"error": "Invalid data: incorrect id or package_id."})
+        return ORJSONResponse(status_code=400, content={"error": "Invalid data: incorrect id or package_id."})
     
     # Validate that priority_boost is a valid integer if sent
-    if priority_boost is not None and not isinstance(priority_boost, int):
+    # bool is a subclass of int, but Stripe would store it as "true"/"false"
+    if priority_boost is not None and type(priority_boost) is not int:
         logging.error(f"Invalid data type for priority_boost: {priority_boost}")
-        return JSONResponse(status_code=400, content={"error": "Invalid data: priority_boost must be an integer."})
-
-    paquete = POINT_PACKAGES[paquete_id]
+        return ORJSONResponse(status_code=400, content={"error": "Invalid data: priority_boost must be an integer."})
 
     try:
         session = stripe.checkout.Session.create(
             payment_method_types=["card"],
-            line_items=[{
-                "price_data": {
-                    "currency": "usd",
-                    "unit_amount": paquete["amount"],
-                    "product_data": {
-                        "name": paquete["label"]
-                    }
-                },
-                "quantity": 1
-            }],
+            line_items=_LINE_ITEMS[paquete_id],
             mode="payment",
             success_url="https://t.me/monkeynudesbot",   # URL de éxito para este bot
             cancel_url="https://t.me/monkeynudesbot",    # URL de cancelación para este bot
             metadata={
+                **_BASE_METADATA[paquete_id],
                 "telegram_id": id,
-                "package_id": paquete_id,
-                "points_awarded": paquete["points"], # Also useful for the webhook
                 "priority_boost": priority_boost,    # ⬅️ We pass the priority_boost in the metadata
-                "project": PROJECT_IDENTIFIER        # <--- AÑADIDO: Identificador del proyecto
             }
         )
         logging.info(f"Stripe session created for user {id}, package {paquete_id}. URL: {session.url}")
         return {"url": session.url}
     except Exception as e:
         logging.error(f"Error creating Stripe session for user {id}, package {paquete_id}: {e}", exc_info=True)
-        return JSONResponse(status_code=500, content={"error": f"Internal error creating session: {str(e)}"})
+        return ORJSONResponse(status_code=500, content={"error": f"Internal error creating session: {str(e)}"})
+
+async def _send_purchase_confirmation(id: int, points_awarded: int, priority_level: int):
+    """
+    Sends the Telegram confirmation for an already applied purchase.
+    Runs as a background task, after the webhook has already answered Stripe.
+    """
+    if not bot: # Only try to send if the bot was initialized correctly
+        logging.warning("Warning: Telegram bot not initialized in Stripe backend (TOKEN missing?). Could not send confirmation.")
+        return
+    try:
+        await bot.send_message(
+            chat_id=id,
+            text=f"🎉 **Recharge successful!** <b>{points_awarded}</b> points have been added to your account. Your queue priority is now <b>{priority_level}</b> (0=Highest).",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logging.error(f"Error sending Telegram confirmation message for {id}: {e}")
 
 @app.post("/webhook/stripe")
-async def stripe_webhook(request: Request, stripe_signature: str = Header(None, alias="Stripe-Signature")):
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks, stripe_signature: str = Header(None, alias="Stripe-Signature")):
     """
     Endpoint that receives Stripe webhooks.
     It is called by Stripe when events like 'checkout.session.completed' occur.
+    The purchase is applied before answering, in a single idempotent database call, so a
+    failure returns 5xx and Stripe's retry re-drives it. Only the Telegram confirmation
+    runs in a background task.
     """
     payload = await request.body()
 
     try:
-        event = stripe.Webhook.construct_event(payload, stripe_signature, STRIPE_WEBHOOK_SECRET)
+        # Signature verification hashes the whole payload; keep it off the event loop.
+        event = await asyncio.to_thread(stripe.Webhook.construct_event, payload, stripe_signature, STRIPE_WEBHOOK_SECRET)
     except stripe.error.SignatureVerificationError as e:
         logging.error(f"Stripe webhook signature verification error: {e}")
         raise HTTPException(status_code=400, detail="Invalid signature")
@@ -128,70 +208,43 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None,
 
         if event_project != PROJECT_IDENTIFIER:
             logging.info(f"Webhook received for project '{event_project}', but this backend is '{PROJECT_IDENTIFIER}'. Ignoring event.")
-            return JSONResponse(status_code=200, content={"status": "ignored", "reason": "project_mismatch"})
+            return ORJSONResponse(status_code=200, content={"status": "ignored", "reason": "project_mismatch"})
     # --- FIN DE LA LÓGICA DE FILTRADO POR METADATA ---
 
     # Handle checkout session completed event
     if event["type"] == "checkout.session.completed":
         session = event["data"]["object"]
-        metadata = session.get("metadata", {})
-        id_str = metadata.get("telegram_id") # Read as string
-        package_id = metadata.get("package_id")
-        points_awarded = metadata.get("points_awarded") # Points to award
-        priority_boost = metadata.get("priority_boost") # ⬅️ Retrieve the priority_boost
-
-        # Safely convert id to int
-        try:
-            id = int(id_str)
-        except (ValueError, TypeError):
-            logging.error(f"Webhook: Invalid or missing id in metadata: {id_str}")
-            return JSONResponse(status_code=400, content={"status": "error", "message": "Invalid id in metadata"})
-
-        # Safely convert points_awarded to int
-        try:
-            points_awarded = int(points_awarded)
-        except (ValueError, TypeError):
-            logging.error(f"Webhook: Invalid or missing points_awarded in metadata: {points_awarded}")
-            points_awarded = 0 # Or handle as error if critical
-
-        # Safely convert priority_boost to int
         try:
-            priority_boost = int(priority_boost)
-        except (ValueError, TypeError):
-            logging.warning(f"Webhook: Invalid or missing priority_boost in metadata: {priority_boost}. Using default priority (2).")
-            priority_boost = 2 # Use default priority if it cannot be converted
-
-        if id is not None and package_id in POINT_PACKAGES:
-            try:
-                # Update user points
-                # Asegúrate de que tu database.py para Monkeyhentai usa la tabla correcta (ej. users_image)
-                database.update_user_points(id, points_awarded) 
-                logging.info(f"User {id} received {points_awarded} points for Stripe purchase.")
-
-                # ⬅️ Update user priority
-                # We only update if the new priority is "better" (numerically lower)
-                database.update_user_priority(id, priority_boost)
-                logging.info(f"User {id} priority updated to {priority_boost} (if better).")
-
-                # Send confirmation message to Telegram user
-                if bot: # Only try to send if the bot was initialized correctly
-                    try:
-                        await bot.send_message(
-                            chat_id=id,
-                            text=f"🎉 **Recharge successful!** <b>{points_awarded}</b> points have been added to your account. Your queue priority is now <b>{priority_boost}</b> (0=Highest).",
-                            parse_mode="HTML"
-                        )
-                    except Exception as e:
-                        logging.error(f"Error sending Telegram confirmation message for {id}: {e}")
-                else:
-                    logging.warning("Warning: Telegram bot not initialized in Stripe backend (TOKEN missing?). Could not send confirmation.")
-            except Exception as e:
-                logging.error(f"Error updating points/priority or sending confirmation for {id}: {e}", exc_info=True)
+            metadata = msgspec.convert(dict(session.get("metadata") or {}), PurchaseMetadata, strict=False)
+        except msgspec.ValidationError as e:
+            logging.error(f"Webhook: Invalid or missing metadata: {e}")
+            return ORJSONResponse(status_code=400, content={"status": "error", "message": "Invalid metadata"})
+
+        if metadata.package_id in POINT_PACKAGES:
+            id = metadata.telegram_id
+            points_awarded = POINT_PACKAGES[metadata.package_id]["points"]
+            priority_boost = _parse_priority_boost(metadata.priority_boost)
+
+            # Recording the session and crediting the user happen in one database transaction,
+            # so a purchase is applied exactly once even if Stripe delivers the event again.
+            # The priority is only changed if the new one is "better" (numerically lower).
+            # Asegúrate de que tu database.py para Monkeyhentai usa la tabla correcta (ej. users_image)
+            # The database module uses the blocking Supabase client, so run it in a thread.
+            user = await asyncio.to_thread(database.process_stripe_purchase, session["id"], id, points_awarded, priority_boost)
+            if user is None:
+                # Nothing was applied; a non-2xx answer makes Stripe retry the event.
+                logging.error(f"Could not apply Stripe purchase {session['id']} for user {id}. Asking Stripe to retry.")
+                return ORJSONResponse(status_code=500, content={"status": "error", "message": "Purchase could not be applied"})
+            if user is False:
+                return ORJSONResponse(status_code=200, content={"status": "ok", "detail": "already_processed"})
+
+            logging.info(f"User {id} received {points_awarded} points for Stripe purchase. Priority is now {user['priority_level']}.")
+            background_tasks.add_task(_send_purchase_confirmation, id, points_awarded, user['priority_level'])
         else:
-            logging.warning(f"Webhook received but incomplete or invalid metadata: id={id_str}, package_id={package_id}")
+            logging.warning(f"Webhook received but invalid package in metadata: id={metadata.telegram_id}, package_id={metadata.package_id}")
 
     # You can handle other Stripe event types here if needed
     # elif event["type"] == "payment_intent.succeeded":
     #     logging.info("Payment Intent succeeded!")
 
-    return JSONResponse(status_code=200, content={"status": "ok"})
+    return ORJSONResponse(status_code=200, content={"status": "ok"})